@@ -1,6 +1,8 @@
-import json
+import os
 import socket
 import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import serial
 import serial.tools.list_ports
 
@@ -10,17 +12,25 @@ from .common.protocol.message_protocol_rs232 import MessageProtocolRS232
 from .common.protocol.message_protocol_tcp import MessageProtocolTCP
 from .domain.exceptions.sdk_exception import OpenLISAException
 
-from .domain.protocol.client_protocol import ClientProtocol
+from .domain.protocol.client_protocol import ClientProtocol, parse_command_execution_result
+from .batch import Batch
+from .common.tcp_connection_pool import tcp_connection_pool
+from .common import serialization
 
 from .domain.exceptions.could_not_connect_to_server import CouldNotConnectToServerException
 from .logging import log
 
 DEFAULT_RS232_BAUDRATE = 921600
+RS232_RX_BUFFER_SIZE = 1 << 20
+RS232_TX_BUFFER_SIZE = 1 << 16
+TIMEOUT_TO_WAIT_HANDSHAKE_RESPONSE = 3
+RS232_HANDSHAKE_CLIENT_REQUEST = b'OPEN'
+RS232_HANDSHAKE_SERVER_RESPONSE = b'LISA'
 
 SDK_RESPONSE_FORMAT_JSON = "JSON"
 SDK_RESPONSE_FORMAT_PYTHON = "PYTHON"
-SDK_VALID_RESPONSE_FORMATS = [
-    SDK_RESPONSE_FORMAT_JSON, SDK_RESPONSE_FORMAT_PYTHON]
+SDK_VALID_RESPONSE_FORMATS = frozenset({
+    SDK_RESPONSE_FORMAT_JSON, SDK_RESPONSE_FORMAT_PYTHON})
 
 CONVERT_TO_STRING = "str"
 CONVERT_TO_DOUBLE = "double"
@@ -36,79 +46,215 @@ AVAILABLE_CONVERT_TYPES = [
     CONVERT_TO_INT,
 ]
 
+RESULT_CONVERTERS = {
+    CONVERT_TO_STRING: str,
+    CONVERT_TO_INT: lambda value: int(float(value)),
+    CONVERT_TO_DOUBLE: float,
+    CONVERT_TO_BYTEARRAY: bytearray,
+    CONVERT_TO_BYTES: bytes,
+}
+
 
 class SDK:
-    def __init__(self, log_level="WARNING", default_response_format=SDK_RESPONSE_FORMAT_PYTHON):
+    def __init__(self, log_level="WARNING", default_response_format=SDK_RESPONSE_FORMAT_PYTHON, cache_parsed_responses=False):
+        """
+        If cache_parsed_responses is True the PYTHON responses of
+        get_instruments, get_instrument and get_instrument_commands are parsed
+        once and shared between calls, so they must not be modified
+        """
         log.set_level(log_level)
         log.info("Initializating SDK")
 
         self._default_response_format = default_response_format
-
-    def connect_through_TCP(self, host, port):
+        self._cache_parsed_responses = cache_parsed_responses
+        self._pooled_connection = None
+        self.__client_protocol = None
+
+    @property
+    def _client_protocol(self):
+        if not self.__client_protocol:
+            raise OpenLISAException(
+                "SDK is disconnected, connect it with the server first")
+        return self.__client_protocol
+
+    @_client_protocol.setter
+    def _client_protocol(self, client_protocol):
+        self.__client_protocol = client_protocol
+
+    def connect_through_TCP(self, host, port, reuse_connection=False):
+        """
+        Connects with the server through TCP. If reuse_connection is True an
+        idle connection from a previous SDK disconnected with the same server
+        is used when available, and the connection is kept open for later
+        reuse on disconnect
+        """
         try:
             server_address = (host, int(port))
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(server_address)
-            self._client_protocol = ClientProtocol(MessageProtocolTCP(sock))
+            sock = tcp_connection_pool.acquire(
+                server_address) if reuse_connection else None
+            if not sock:
+                sock = self.__create_tcp_socket(server_address)
+            message_protocol = MessageProtocolTCP(sock)
+            self._pooled_connection = (
+                server_address, sock, message_protocol) if reuse_connection else None
+            self._client_protocol = ClientProtocol(message_protocol)
         except Exception as e:
             log.error(e)
             raise CouldNotConnectToServerException(
                 "could not connect with server at {} through TCP".format(server_address))
 
-    def connect_through_RS232(self, baudrate=DEFAULT_RS232_BAUDRATE, port=None):
-        # Discover server RS232
-        TIMEOUT_TO_WAIT_HANDSHAKE_RESPONSE = 3
-        RS232_HANDSHAKE_CLIENT_REQUEST = 'OPEN'
-        RS232_HANDSHAKE_SERVER_RESPONSE = 'LISA'
+    def __create_tcp_socket(self, server_address):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(server_address)
+        # Requests are made of several small frames followed by a blocking
+        # read, so Nagle's algorithm would only add latency to every call
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        return sock
 
-        connection = None
+    def connect_through_RS232(self, baudrate=DEFAULT_RS232_BAUDRATE, port=None, low_latency=True):
+        # Discover server RS232
         detected_ports_info_instances = serial.tools.list_ports.comports()
         detected_port_devices = [
             pinfo.device for pinfo in detected_ports_info_instances]
         ports_to_try = detected_port_devices if not port else [port]
-        for port in ports_to_try:
+
+        # Ports are probed concurrently so discovery takes a single handshake
+        # timeout instead of one per detected port
+        connection = None
+        probes = []
+
+        def close_unused_connection(probe):
+            if probe.exception():
+                return
+            probe_connection = probe.result()
+            if probe_connection and probe_connection is not connection:
+                probe_connection.close()
+
+        if ports_to_try:
+            executor = ThreadPoolExecutor(max_workers=len(ports_to_try))
+            probes = [executor.submit(self.__probe_rs232_port, port_to_try, baudrate)
+                      for port_to_try in ports_to_try]
+            executor.shutdown(wait=False)
             try:
-                log.debug(
-                    '[connect_through_RS232] trying to connect to {}'.format(port))
-                connection = serial.Serial(
-                    port=port, baudrate=baudrate, timeout=TIMEOUT_TO_WAIT_HANDSHAKE_RESPONSE)
-                log.debug(
-                    '[connect_through_RS232] connection created {}'.format(connection))
-                if not connection.is_open:
-                    connection.open()
-
-                # custom handshake
-                MAX_UNSIGNED_INT = 4_294_967_295
-                log.debug(
-                    '[connect_through_RS232] setting buffer size to {}B'.format(4_294_967_295))
-                connection.set_buffer_size(
-                    rx_size=MAX_UNSIGNED_INT, tx_size=MAX_UNSIGNED_INT)
-                connection.write(RS232_HANDSHAKE_CLIENT_REQUEST.encode())
-                response = connection.read(
-                    len(RS232_HANDSHAKE_SERVER_RESPONSE))
-                if len(response) > 0 and str(response.decode()) == RS232_HANDSHAKE_SERVER_RESPONSE:
-                    log.debug('Detect Open LISA server at {} with baudrate {}'.format(
-                        port, baudrate))
-                    break
-                else:
-                    connection = None
-                    log.debug("no answer detected from {}".format(port))
-            except serial.SerialException as ex:
-                log.info('serial exception {}'.format(ex))
-                log.debug('exception stacktrace {}'.format(
-                    traceback.format_exc()))
-                log.debug("could not connect to {}".format(port))
-                connection = None
+                for probe in as_completed(probes):
+                    connection = probe.result()
+                    if connection:
+                        break
+            finally:
+                # Every port opened by a probe other than the chosen one is
+                # closed, now or when the probe finishes
+                for probe in probes:
+                    probe.add_done_callback(close_unused_connection)
 
         if not connection:
             raise CouldNotConnectToServerException(
                 "could not detect Open LISA server listening through RS232")
 
+        if low_latency:
+            self.__enable_rs232_low_latency(connection)
+
+        self._pooled_connection = None
         self._client_protocol = ClientProtocol(
             MessageProtocolRS232(rs232_connection=connection))
 
+    def __probe_rs232_port(self, port, baudrate):
+        """
+        Returns an open connection with the port if the Open LISA server
+        answers the handshake through it, None otherwise
+        """
+        connection = None
+        try:
+            log.debug(
+                '[connect_through_RS232] trying to connect to {}'.format(port))
+            connection = serial.Serial(
+                port=port, baudrate=baudrate, timeout=TIMEOUT_TO_WAIT_HANDSHAKE_RESPONSE)
+            log.debug(
+                '[connect_through_RS232] connection created {}'.format(connection))
+            if not connection.is_open:
+                connection.open()
+
+            # custom handshake
+            log.debug('[connect_through_RS232] setting buffer size to {}B rx and {}B tx'.format(
+                RS232_RX_BUFFER_SIZE, RS232_TX_BUFFER_SIZE))
+            try:
+                connection.set_buffer_size(
+                    rx_size=RS232_RX_BUFFER_SIZE, tx_size=RS232_TX_BUFFER_SIZE)
+            except AttributeError:
+                # set_buffer_size is only available on Windows
+                pass
+            connection.write(RS232_HANDSHAKE_CLIENT_REQUEST)
+            response = connection.read(
+                len(RS232_HANDSHAKE_SERVER_RESPONSE))
+            # Compared as bytes since other devices may answer with
+            # anything, including invalid UTF-8
+            if response == RS232_HANDSHAKE_SERVER_RESPONSE:
+                log.debug('Detect Open LISA server at {} with baudrate {}'.format(
+                    port, baudrate))
+                return connection
+
+            log.debug("no answer detected from {}".format(port))
+        except Exception as ex:
+            # Any failure only rules out this port, the other ones are still
+            # being probed
+            log.info('exception while probing {}: {}'.format(port, ex))
+            log.debug('exception stacktrace {}'.format(
+                traceback.format_exc()))
+            log.debug("could not connect to {}".format(port))
+
+        if connection:
+            try:
+                connection.close()
+            except Exception as ex:
+                log.debug('could not close {}: {}'.format(port, ex))
+        return None
+
+    def __enable_rs232_low_latency(self, connection):
+        # USB-serial adapters hold incoming bytes up to 16ms by default before
+        # handing them to the host, which is added to every message received
+        try:
+            connection.set_low_latency_mode(True)
+            log.debug('[connect_through_RS232] low latency mode enabled')
+            return
+        except (AttributeError, NotImplementedError, ValueError) as e:
+            # set_low_latency_mode is only available on POSIX platforms and
+            # not every driver supports it
+            log.debug(
+                '[connect_through_RS232] could not enable low latency mode: {}'.format(e))
+
+        latency_timer_path = '/sys/bus/usb-serial/devices/{}/latency_timer'.format(
+            os.path.basename(connection.port))
+        try:
+            with open(latency_timer_path, 'w') as latency_timer:
+                latency_timer.write('1')
+            log.debug('[connect_through_RS232] latency timer set to 1ms')
+        except OSError as e:
+            log.debug(
+                '[connect_through_RS232] could not set latency timer: {}'.format(e))
+
     def disconnect(self):
-        self._client_protocol.disconnect()
+        client_protocol = self._client_protocol
+        # Once disconnected the connection is not used anymore, pooled ones
+        # may even be handed to another SDK
+        self._client_protocol = None
+        if self._pooled_connection:
+            server_address, sock, message_protocol = self._pooled_connection
+            self._pooled_connection = None
+            # Unread bytes would be taken as the response to the next request
+            # of whoever reuses the connection, so it is closed instead
+            if (not message_protocol.has_unread_data()
+                    and tcp_connection_pool.release(server_address, sock)):
+                return
+
+        client_protocol.disconnect()
+
+    def invalidate_cache(self):
+        """
+        Drops the responses cached when cache_parsed_responses is enabled.
+        Responses are cached by their content, so a changed response is never
+        served from the cache and this only frees the memory they take
+        """
+        serialization.cached_loads.cache_clear()
 
     def __reset_databases(self):
         return self._client_protocol.reset_databases()
@@ -120,12 +266,12 @@ class SDK:
 
     def update_instrument(self, instrument_id, updated_instrument, response_format=None):
         updated_instrument_as_json_string = self._client_protocol.update_instrument_as_json_string(
-            instrument_id, updated_instrument)
+            str(instrument_id), updated_instrument)
         return self.__format_response(updated_instrument_as_json_string, response_format)
 
     def delete_instrument(self, instrument_id, response_format=None):
         deleted_instrument = self._client_protocol.delete_instrument_as_json_string(
-            instrument_id)
+            str(instrument_id))
         return self.__format_response(deleted_instrument, response_format)
 
     def get_instruments(self, response_format=None):
@@ -133,25 +279,25 @@ class SDK:
         Returns the list of instruments dictionaries
         """
         instruments_as_json_string = self._client_protocol.get_instruments_as_json_string()
-        return self.__format_response(instruments_as_json_string, response_format)
+        return self.__format_response(instruments_as_json_string, response_format, cacheable=True)
 
     def get_instrument(self, instrument_id, response_format=None):
         """
         Returns the instrument with the ID specified, raises if not found
         """
         instrument_as_json_string = self._client_protocol.get_instrument_as_json_string(
-            instrument_id)
-        return self.__format_response(instrument_as_json_string, response_format)
+            str(instrument_id))
+        return self.__format_response(instrument_as_json_string, response_format, cacheable=True)
 
     def get_instrument_commands(self, instrument_id, response_format=None):
         commands_as_json_string = self._client_protocol.get_instrument_commands_as_json_string(
-            id=instrument_id)
-        return self.__format_response(commands_as_json_string, response_format)
+            id=str(instrument_id))
+        return self.__format_response(commands_as_json_string, response_format, cacheable=True)
 
     def is_valid_command_invocation(self, instrument_id, command_invocation):
         try:
             self._client_protocol.validate_command(
-                instrument_id, command_invocation)
+                str(instrument_id), command_invocation)
             print("{} is OK".format(command_invocation))
             return True
         except InvalidCommandException as e:
@@ -159,31 +305,57 @@ class SDK:
             return False
 
     def send_command(self, instrument_id, command_invocation, response_format=None, convert_result_to=None):
-        if response_format == SDK_RESPONSE_FORMAT_JSON or (
-                response_format == None and self._default_response_format == SDK_RESPONSE_FORMAT_JSON):
+        instrument_id = str(instrument_id)
+        if self.__is_json_response_format(response_format):
             # If response format is json convert_result_to is ignored
             return self._client_protocol.send_command_and_result_as_json_string(instrument_id, command_invocation)
 
         command_execution_result = self._client_protocol.send_command(
             instrument_id, command_invocation)
+        return self.__convert_command_result(command_execution_result, convert_result_to)
+
+    @contextmanager
+    def batch(self):
+        """
+        Yields a Batch where get_instruments, get_instrument,
+        get_instrument_commands and send_command calls are queued. They are
+        sent together when the block ends, paying a single round trip with the
+        server, and their results are available in Batch.results
+        """
+        batch = None
+        try:
+            with self._client_protocol.pipeline() as pipeline:
+                batch = Batch(pipeline, self.__format_response,
+                              self.__format_command_result)
+                yield batch
+        finally:
+            # Results are formatted once, even if some request failed
+            if batch:
+                batch.format_results()
+
+        for result in batch.results:
+            if isinstance(result, Exception):
+                raise result
+
+    def __is_json_response_format(self, response_format):
+        return response_format == SDK_RESPONSE_FORMAT_JSON or (
+            response_format == None and self._default_response_format == SDK_RESPONSE_FORMAT_JSON)
+
+    def __format_command_result(self, json_string, response_format, convert_result_to):
+        if self.__is_json_response_format(response_format):
+            return json_string
 
-        if not convert_result_to:
+        command_execution_result = parse_command_execution_result(json_string)
+        return self.__convert_command_result(command_execution_result, convert_result_to)
+
+    def __convert_command_result(self, command_execution_result, convert_result_to):
+        convert = RESULT_CONVERTERS.get(convert_result_to)
+        if not convert:
             return command_execution_result
 
         original_value = command_execution_result["value"]
         try:
-            if convert_result_to == CONVERT_TO_STRING:
-                command_execution_result["value"] = str(original_value)
-            elif convert_result_to == CONVERT_TO_INT:
-                command_execution_result["value"] = \
-                    int(float((original_value)))
-            elif convert_result_to == CONVERT_TO_DOUBLE:
-                command_execution_result["value"] = float(original_value)
-            elif convert_result_to == CONVERT_TO_BYTEARRAY:
-                command_execution_result["value"] = bytearray(original_value)
-            elif convert_result_to == CONVERT_TO_BYTES:
-                command_execution_result["value"] = bytes(original_value)
-
+            command_execution_result["value"] = convert(original_value)
         except ValueError as e:
             error = "could not convert '{}' to type '{}'.".format(
                 original_value, convert_result_to)
@@ -194,21 +366,23 @@ class SDK:
 
     def send_file(self, file_path, file_target_name):
         with open(file_path, "rb") as file:
-            data = file.read()
-            return self._client_protocol.send_file(data, file_target_name)
+            size = os.fstat(file.fileno()).st_size
+            return self._client_protocol.send_file_stream(file, size, file_target_name)
 
     def get_file(self, remote_file_name, file_target_name):
-        file_bytes = self._client_protocol.get_file(remote_file_name)
-        with open(file_target_name, "wb") as file:
-            file.write(file_bytes)
+        self._client_protocol.get_file_to(remote_file_name, file_target_name)
 
     def execute_bash_command(self, command, capture_stdout=False, capture_stderr=False):
         return self._client_protocol.execute_bash_command(command, capture_stdout, capture_stderr)
 
-    def __format_response(self, json_string, response_format):
+    def __format_response(self, json_string, response_format, cacheable=False):
         response_format = response_format if response_format else self._default_response_format
-        assert response_format in SDK_VALID_RESPONSE_FORMATS
+        if response_format not in SDK_VALID_RESPONSE_FORMATS:
+            raise ValueError("invalid response format '{}', valid formats are {}".format(
+                response_format, sorted(SDK_VALID_RESPONSE_FORMATS)))
         if response_format == SDK_RESPONSE_FORMAT_JSON:
             return json_string
         elif response_format == SDK_RESPONSE_FORMAT_PYTHON:
-            return json.loads(json_string)
+            if cacheable and self._cache_parsed_responses:
+                return serialization.cached_loads(json_string)
+            return serialization.loads(json_string)
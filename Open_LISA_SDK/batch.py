@@ -0,0 +1,54 @@
+from .domain.exceptions.sdk_exception import OpenLISAException
+
+
+class Batch:
+    """
+    Queues SDK requests that are sent together when the SDK.batch block ends.
+    The methods take the same arguments as their SDK counterparts but return
+    nothing, results are read from Batch.results instead
+    """
+
+    def __init__(self, pipeline, format_response, format_command_result):
+        self._pipeline = pipeline
+        self._format_response = format_response
+        self._format_command_result = format_command_result
+        self._formatters = []
+        # Formatted result of each request once the block ends, or the
+        # exception raised for it
+        self.results = []
+
+    def get_instruments(self, response_format=None):
+        self._pipeline.get_instruments_as_json_string()
+        self._formatters.append(
+            lambda result: self._format_response(result, response_format))
+
+    def get_instrument(self, instrument_id, response_format=None):
+        self._pipeline.get_instrument_as_json_string(str(instrument_id))
+        self._formatters.append(
+            lambda result: self._format_response(result, response_format))
+
+    def get_instrument_commands(self, instrument_id, response_format=None):
+        self._pipeline.get_instrument_commands_as_json_string(str(instrument_id))
+        self._formatters.append(
+            lambda result: self._format_response(result, response_format))
+
+    def send_command(self, instrument_id, command_invocation, response_format=None, convert_result_to=None):
+        self._pipeline.send_command_and_result_as_json_string(
+            str(instrument_id), command_invocation)
+        self._formatters.append(lambda result: self._format_command_result(
+            result, response_format, convert_result_to))
+
+    def format_results(self):
+        """
+        Formats the results read by the pipeline, keeping them in the same
+        order the requests were queued. Failed requests, or results that could
+        not be converted, hold the exception raised for them
+        """
+        self.results = []
+        for format_result, result in zip(self._formatters, self._pipeline.results):
+            if not isinstance(result, Exception):
+                try:
+                    result = format_result(result)
+                except OpenLISAException as e:
+                    result = e
+            self.results.append(result)
@@ -1,3 +1,11 @@
+import struct
+
+STREAM_CHUNK_SIZE = 64 * 1024
+# Every message is prefixed with its length as a 4-byte unsigned int in
+# network byte order
+MESSAGE_LENGTH_HEADER = struct.Struct('>I')
+
+
 class MessageProtocol:
     def disconnect(self):
         raise NotImplementedError("Please Implement this method: disconnect")
@@ -5,8 +13,20 @@ class MessageProtocol:
     def send_msg(self, msg, encode=True):
         raise NotImplementedError("Please Implement this method: send_msg")
 
+    def send_msgs(self, msgs):
+        raise NotImplementedError("Please Implement this method: send_msgs")
+
+    def send_stream(self, file, size):
+        raise NotImplementedError("Please Implement this method: send_stream")
+
     def receive_msg(self, decode=True):
         raise NotImplementedError("Please Implement this method: receive_msg")
 
+    def receive_stream(self, file):
+        raise NotImplementedError("Please Implement this method: receive_stream")
+
+    def discard_msg(self):
+        raise NotImplementedError("Please Implement this method: discard_msg")
+
     def __recvall(self, n):
         raise NotImplementedError("Please Implement this method: __recvall")
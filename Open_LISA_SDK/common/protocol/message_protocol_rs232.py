@@ -1,6 +1,5 @@
-import struct
 import time
-from .message_protocol import MessageProtocol
+from .message_protocol import MessageProtocol, MESSAGE_LENGTH_HEADER, STREAM_CHUNK_SIZE
 from ...logging import log
 
 # TODO: Duplicado en server y SDK, ver de usar uno en comun
@@ -27,27 +26,90 @@ class MessageProtocolRS232(MessageProtocol):
         if encode:
             msg = msg.encode()
         # Prefix each message with a 4-byte length
-        msg = struct.pack('>I', len(msg)) + msg
+        msg = MESSAGE_LENGTH_HEADER.pack(len(msg)) + msg
         self._connection.write(msg)
 
+    def send_msgs(self, msgs):
+        # Frame every message and write them all at once, str messages are
+        # encoded while bytes are sent as they are
+        data = bytearray()
+        for msg in msgs:
+            if isinstance(msg, str):
+                msg = msg.encode()
+            data.extend(MESSAGE_LENGTH_HEADER.pack(len(msg)))
+            data.extend(msg)
+        self._connection.write(data)
+
+    def send_stream(self, file, size):
+        # Sends the next size bytes of the file as a single message without
+        # loading the whole file in memory
+        self._connection.write(MESSAGE_LENGTH_HEADER.pack(size))
+        remaining = size
+        while remaining:
+            chunk = file.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError("file ended before {} bytes were sent".format(size))
+            self._connection.write(chunk)
+            remaining -= len(chunk)
+
     def receive_msg(self, decode=True):
         # Read message length and unpack it into an integer
-        raw_msglen = self.__recvall(4)
+        raw_msglen = self.__recvall(MESSAGE_LENGTH_HEADER.size)
         if not raw_msglen:
             raise ConnectionResetError
-        msglen = struct.unpack('>I', raw_msglen)[0]
+        msglen = MESSAGE_LENGTH_HEADER.unpack(raw_msglen)[0]
         # Read the message data
         data = self.__recvall(msglen)
         if decode:
             data = data.decode()
         return data
 
+    def receive_stream(self, file):
+        # Writes the next message into the file as it arrives, without
+        # holding it whole in memory. Returns the amount of bytes written.
+        # If writing fails the rest of the message is still read, so the
+        # connection stays in sync, before raising the error
+        msglen = self.__receive_msglen()
+        write_error = None
+        for packet in self.__receive_packets(msglen):
+            if write_error is None:
+                try:
+                    file.write(packet)
+                except Exception as e:
+                    write_error = e
+        if write_error is not None:
+            raise write_error
+        return msglen
+
+    def discard_msg(self):
+        # Reads the next message without keeping it in memory
+        for _ in self.__receive_packets(self.__receive_msglen()):
+            pass
+
+    def __receive_msglen(self):
+        raw_msglen = self.__recvall(MESSAGE_LENGTH_HEADER.size)
+        if not raw_msglen:
+            raise ConnectionResetError
+        return MESSAGE_LENGTH_HEADER.unpack(raw_msglen)[0]
+
+    def __receive_packets(self, msglen):
+        # Yields the msglen bytes of a message as they arrive
+        remaining = msglen
+        while remaining:
+            packet = self._connection.read(min(STREAM_CHUNK_SIZE, remaining))
+            if not packet:
+                raise ConnectionResetError
+            remaining -= len(packet)
+            yield packet
+
     def __recvall(self, n):
-        # Helper function to recv n bytes or raise ConnectionResetError if EOF is hit
+        # Helper function to recv n bytes or raise ConnectionResetError if EOF is hit.
+        # Every read call has a fixed cost of about 1ms on some platforms, so
+        # all the missing bytes are requested at once. More than one read is
+        # only needed when the transfer takes longer than the read timeout
         data = bytearray()
         while len(data) < n:
-            bytes_to_read = max(1, min(2048, self._connection.in_waiting, n - len(data)))
-            packet = self._connection.read(bytes_to_read)
+            packet = self._connection.read(n - len(data))
             if not packet:
                 raise ConnectionResetError
             data.extend(packet)
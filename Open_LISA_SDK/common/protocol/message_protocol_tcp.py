@@ -1,6 +1,7 @@
 import socket
-import struct
-from .message_protocol import MessageProtocol
+from .message_protocol import MessageProtocol, MESSAGE_LENGTH_HEADER, STREAM_CHUNK_SIZE
+
+READ_AHEAD_SIZE = 64 * 1024
 
 
 # TODO: Duplicado en server y SDK, ver de usar uno en comun
@@ -8,6 +9,8 @@ from .message_protocol import MessageProtocol
 class MessageProtocolTCP(MessageProtocol):
     def __init__(self, tcp_socket):
         self._socket = tcp_socket
+        # Bytes already received that belong to the next messages
+        self._received = bytearray()
 
     def disconnect(self):
         try:
@@ -16,31 +19,116 @@ class MessageProtocolTCP(MessageProtocol):
             pass
         self._socket.close()
 
+    def has_unread_data(self):
+        return len(self._received) > 0
+
     def send_msg(self, msg, encode=True):
         if encode:
             msg = msg.encode()
         # Prefix each message with a 4-byte length (network byte order)
-        msg = struct.pack('>I', len(msg)) + msg
+        msg = MESSAGE_LENGTH_HEADER.pack(len(msg)) + msg
         self._socket.sendall(msg)
 
+    def send_msgs(self, msgs):
+        # Frame every message and write them all at once, str messages are
+        # encoded while bytes are sent as they are
+        data = bytearray()
+        for msg in msgs:
+            if isinstance(msg, str):
+                msg = msg.encode()
+            data.extend(MESSAGE_LENGTH_HEADER.pack(len(msg)))
+            data.extend(msg)
+        self._socket.sendall(data)
+
+    def send_stream(self, file, size):
+        # Sends the next size bytes of the file as a single message, letting
+        # the kernel copy them straight from the file when possible
+        self._socket.sendall(MESSAGE_LENGTH_HEADER.pack(size))
+        sent = self._socket.sendfile(file, count=size)
+        if sent != size:
+            raise EOFError("file ended before {} bytes were sent".format(size))
+
     def receive_msg(self, decode=True):
         # Read message length and unpack it into an integer
-        raw_msglen = self.__recvall(4)
+        raw_msglen = self.__recvall(MESSAGE_LENGTH_HEADER.size)
         if not raw_msglen:
             raise ConnectionResetError
-        msglen = struct.unpack('>I', raw_msglen)[0]
+        msglen = MESSAGE_LENGTH_HEADER.unpack(raw_msglen)[0]
         # Read the message data
         data = self.__recvall(msglen)
         if decode:
             data = data.decode()
         return data
 
+    def receive_stream(self, file):
+        # Writes the next message into the file as it arrives, without
+        # holding it whole in memory. Returns the amount of bytes written.
+        # If writing fails the rest of the message is still read, so the
+        # connection stays in sync, before raising the error
+        msglen = self.__receive_msglen()
+        write_error = None
+        for packet in self.__receive_packets(msglen):
+            if write_error is None:
+                try:
+                    file.write(packet)
+                except Exception as e:
+                    write_error = e
+        if write_error is not None:
+            raise write_error
+        return msglen
+
+    def discard_msg(self):
+        # Reads the next message without keeping it in memory
+        for _ in self.__receive_packets(self.__receive_msglen()):
+            pass
+
+    def __receive_msglen(self):
+        raw_msglen = self.__recvall(MESSAGE_LENGTH_HEADER.size)
+        if not raw_msglen:
+            raise ConnectionResetError
+        return MESSAGE_LENGTH_HEADER.unpack(raw_msglen)[0]
+
+    def __receive_packets(self, msglen):
+        # Yields the msglen bytes of a message as they arrive. Each packet is
+        # only valid until the next one is requested
+        buffered = self._received[:msglen]
+        del self._received[:msglen]
+        if buffered:
+            yield buffered
+        chunk = memoryview(bytearray(STREAM_CHUNK_SIZE))
+        remaining = msglen - len(buffered)
+        while remaining:
+            received = self._socket.recv_into(
+                chunk, min(STREAM_CHUNK_SIZE, remaining))
+            if not received:
+                raise ConnectionResetError
+            remaining -= received
+            yield chunk[:received]
+
     def __recvall(self, n):
-        # Helper function to recv n bytes or raise ConnectionResetError if EOF is hit
-        data = bytearray()
-        while len(data) < n:
-            packet = self._socket.recv(n - len(data))
-            if not packet:
+        # Helper function to recv n bytes or raise ConnectionResetError if EOF is hit.
+        # Small messages are read ahead so consecutive ones, like a response
+        # type and its result, are usually received with a single recv call
+        if n <= READ_AHEAD_SIZE:
+            while len(self._received) < n:
+                packet = self._socket.recv(READ_AHEAD_SIZE)
+                if not packet:
+                    raise ConnectionResetError
+                self._received.extend(packet)
+            data = self._received[:n]
+            del self._received[:n]
+            return data
+
+        # Big messages are received straight into their final buffer
+        data = bytearray(n)
+        view = memoryview(data)
+        received = len(self._received)
+        view[:received] = self._received
+        self._received = bytearray()
+        while received < n:
+            packet_size = self._socket.recv_into(view[received:], n - received)
+            if not packet_size:
                 raise ConnectionResetError
-            data.extend(packet)
+            received += packet_size
+        view.release()
         return data
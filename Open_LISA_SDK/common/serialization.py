@@ -0,0 +1,43 @@
+import json
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# orjson is used when installed since it parses and serializes large
+# payloads several times faster. Its dumps returns bytes instead of str, both
+# can be sent through MessageProtocol.send_msgs.
+# orjson rejects some payloads the json module accepts, like integers that do
+# not fit in 64 bits when serializing or NaN/Infinity when parsing, so those
+# are handled by json instead. Non str keys are converted to str by both.
+# Remaining differences: orjson serializes NaN/Infinity floats as null and
+# parses integers that do not fit in 64 bits as floats
+if orjson:
+    def loads(json_string):
+        try:
+            return orjson.loads(json_string)
+        except ValueError:
+            return json.loads(json_string)
+
+    def dumps(obj):
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            return json.dumps(obj)
+else:
+    loads = json.loads
+    dumps = json.dumps
+
+
+PARSED_RESPONSES_CACHE_SIZE = 128
+
+
+@lru_cache(maxsize=PARSED_RESPONSES_CACHE_SIZE)
+def cached_loads(json_string):
+    """
+    Same as loads but results are cached by their JSON string, so equal
+    strings return the same object which must not be modified
+    """
+    return loads(json_string)
@@ -0,0 +1,99 @@
+import socket
+import threading
+import time
+
+from ..logging import log
+
+DEFAULT_MAX_IDLE_CONNECTIONS = 20
+DEFAULT_IDLE_TIMEOUT_SECONDS = 60
+
+
+class TCPConnectionPool:
+    """
+    Keeps idle TCP connections with the server, grouped by server address, so
+    they can be reused by later connections instead of opening new ones.
+    Connections idle for longer than idle_timeout seconds are closed the next
+    time the pool is used.
+    """
+
+    def __init__(self, max_idle=DEFAULT_MAX_IDLE_CONNECTIONS, idle_timeout=DEFAULT_IDLE_TIMEOUT_SECONDS):
+        self._max_idle = max_idle
+        self._idle_timeout = idle_timeout
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, server_address):
+        """
+        Returns an idle connection with the server or None if there is none
+        """
+        with self._lock:
+            self.__close_expired_connections()
+            connections = self._idle_connections.get(server_address, [])
+            while connections:
+                sock, _ = connections.pop()
+                if self.__is_healthy(sock):
+                    log.debug('[TCPConnectionPool] reusing connection with {}'.format(
+                        server_address))
+                    return sock
+                sock.close()
+
+        return None
+
+    def release(self, server_address, sock):
+        """
+        Returns the connection to the pool. Returns False if the pool is full
+        and the connection must be closed by the caller
+        """
+        if not self.__is_healthy(sock):
+            sock.close()
+            return True
+
+        with self._lock:
+            self.__close_expired_connections()
+            idle_count = sum(len(connections)
+                             for connections in self._idle_connections.values())
+            if idle_count >= self._max_idle:
+                return False
+
+            self._idle_connections.setdefault(server_address, []).append(
+                (sock, time.monotonic()))
+            return True
+
+    def close_all(self):
+        with self._lock:
+            for connections in self._idle_connections.values():
+                for sock, _ in connections:
+                    sock.close()
+            self._idle_connections = {}
+
+    def __close_expired_connections(self):
+        now = time.monotonic()
+        for server_address, connections in self._idle_connections.items():
+            alive = []
+            for sock, released_at in connections:
+                if now - released_at > self._idle_timeout:
+                    sock.close()
+                else:
+                    alive.append((sock, released_at))
+            self._idle_connections[server_address] = alive
+
+    def __is_healthy(self, sock):
+        try:
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                return False
+
+            # An idle connection must not have anything to read, EOF means
+            # the server closed it and unexpected data would break the protocol
+            sock.setblocking(False)
+            try:
+                sock.recv(1, socket.MSG_PEEK)
+                return False
+            except BlockingIOError:
+                return True
+            finally:
+                sock.setblocking(True)
+        except OSError:
+            return False
+
+
+tcp_connection_pool = TCPConnectionPool()
@@ -1,12 +1,14 @@
-import base64
-import json
-from time import time
+import binascii
+import os
+from contextlib import contextmanager, suppress
 
 from ..exceptions.invalid_path_exception import InvalidPathException
+from ...common import serialization
 from ...common.protocol.message_protocol import MessageProtocol
 from ..exceptions.sdk_exception import OpenLISAException
 from ..exceptions.invalid_command import InvalidCommandException
 from ...logging import log
+from ...logging.latency import with_latency_logs
 
 SUCCESS_RESPONSE = "OK"
 ERROR_RESPONSE = "ERROR"
@@ -26,244 +28,301 @@ COMMAND_EXECUTE_BASH = "EXECUTE_BASH"
 # Only available when server is running in test mode
 COMMAND_RESET_DATABASES = "RESET_DATABASES"
 
+PARTIAL_FILE_SUFFIX = ".part"
+
+
+def is_valid_response(response):
+    if response == SUCCESS_RESPONSE:
+        return True
+    if response == ERROR_RESPONSE:
+        return False
+
+    raise Exception("unknown response type: '{}'".format(response))
+
+
+def invalid_command_exception(id, command):
+    def exception(err):
+        return InvalidCommandException(
+            "command '{}' for instrument {} is not valid: {}".format(command, id, err))
+
+    return exception
+
+
+def invalid_command_invocation_exception(command):
+    def exception(err):
+        return InvalidCommandException(
+            "command '{}' is not valid: {}".format(command, err))
+
+    return exception
+
+
+def parse_command_execution_result(json_str):
+    command_execution_result_dict = serialization.loads(json_str)
+    # Released before decoding so big results are not held twice
+    del json_str
+    # BYTES are sent as a base64 string
+    if command_execution_result_dict["type"] == "BYTES":
+        command_execution_result_dict["value"] = binascii.a2b_base64(
+            command_execution_result_dict["value"])
+    return command_execution_result_dict
+
 
 class ClientProtocol:
     def __init__(self, message_protocol: MessageProtocol):
         self._message_protocol = message_protocol
+        # Bound once since they are called several times on every request
+        self._send_msg = message_protocol.send_msg
+        self._send_msgs = message_protocol.send_msgs
+        self._receive_msg = message_protocol.receive_msg
+
+    def __request(self, msgs, error_exception=OpenLISAException):
+        """
+        Sends the request messages and returns the result message, the server
+        always answers with a response type followed by the result or error
+        """
+        self._send_msgs(msgs)
+        response_type = self._receive_msg()
+        result_msg = self._receive_msg()
+        if is_valid_response(response_type):
+            return result_msg
 
-    def __is_valid_response(self, response):
-        if response == SUCCESS_RESPONSE:
-            return True
-        if response == ERROR_RESPONSE:
-            return False
-
-        raise Exception("unknown response type: '{}'".format(response))
-
+        raise error_exception(result_msg)
+
+    def __request_ack(self, msgs, error_exception=OpenLISAException):
+        """
+        Sends the request messages and returns the response type, the error
+        message is only sent by the server when the request fails
+        """
+        self._send_msgs(msgs)
+        response_type = self._receive_msg()
+        if is_valid_response(response_type):
+            return response_type
+
+        raise error_exception(self._receive_msg())
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Yields a ClientProtocolPipeline whose queued requests are sent
+        together when the block ends
+        """
+        pipeline = ClientProtocolPipeline(self._message_protocol)
+        yield pipeline
+        pipeline.flush()
+
+    @with_latency_logs
     def disconnect(self):
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('disconnect'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_DISCONNECT)
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-            'disconnect', te-ts))
+        self._send_msg(COMMAND_DISCONNECT)
         self._message_protocol.disconnect()
         return
 
     def create_instrument(self, new_instrument):
-        return json.loads(self.get_instrument_as_json_string(new_instrument))
+        return serialization.loads(self.create_instrument_as_json_string(new_instrument))
 
+    @with_latency_logs
     def create_instrument_as_json_string(self, new_instrument):
-        self._message_protocol.send_msg(COMMAND_CREATE_INSTRUMENT)
-        self._message_protocol.send_msg(json.dumps(new_instrument))
-        response_type = self._message_protocol.receive_msg()
-        result_msg = self._message_protocol.receive_msg()
-        if self.__is_valid_response(response_type):
-            return result_msg
-        else:
-            raise OpenLISAException(result_msg)
+        return self.__request([COMMAND_CREATE_INSTRUMENT, serialization.dumps(new_instrument)])
 
     def update_instrument(self, id, updated_instrument):
-        id = str(id)
-        return json.loads(self.update_instrument_as_json_string(id, updated_instrument))
+        return serialization.loads(self.update_instrument_as_json_string(id, updated_instrument))
 
+    @with_latency_logs
     def update_instrument_as_json_string(self, id, updated_instrument):
-        id = str(id)
-        self._message_protocol.send_msg(COMMAND_UPDATE_INSTRUMENT)
-        self._message_protocol.send_msg(id)
-        self._message_protocol.send_msg(json.dumps(updated_instrument))
-        response_type = self._message_protocol.receive_msg()
-        result_msg = self._message_protocol.receive_msg()
-        if self.__is_valid_response(response_type):
-            return result_msg
-        else:
-            raise OpenLISAException(result_msg)
+        return self.__request([COMMAND_UPDATE_INSTRUMENT, id, serialization.dumps(updated_instrument)])
 
     def delete_instrument(self, id):
-        id = str(id)
-        return json.loads(self.delete_instrument_as_json_string(id))
+        return serialization.loads(self.delete_instrument_as_json_string(id))
 
+    @with_latency_logs
     def delete_instrument_as_json_string(self, id):
-        id = str(id)
-        self._message_protocol.send_msg(COMMAND_DELETE_INSTRUMENT)
-        self._message_protocol.send_msg(id)
-        response_type = self._message_protocol.receive_msg()
-        result_msg = self._message_protocol.receive_msg()
-        if self.__is_valid_response(response_type):
-            return result_msg
-        else:
-            raise OpenLISAException(result_msg)
+        return self.__request([COMMAND_DELETE_INSTRUMENT, id])
 
     def get_instruments(self):
-        return json.loads(self.get_instruments_as_json_string())
+        return serialization.loads(self.get_instruments_as_json_string())
 
+    @with_latency_logs
     def get_instruments_as_json_string(self):
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('get_instruments'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_GET_INSTRUMENTS)
-        result = self._message_protocol.receive_msg()
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-            'get_instruments', te-ts))
-        return result
+        self._send_msg(COMMAND_GET_INSTRUMENTS)
+        return self._receive_msg()
 
     def get_instrument(self, id):
-        id = str(id)
-        return json.loads(self.get_instrument_as_json_string(id))
+        return serialization.loads(self.get_instrument_as_json_string(id))
 
+    @with_latency_logs
     def get_instrument_as_json_string(self, id):
-        id = str(id)
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('get_instrument'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_GET_INSTRUMENT)
-        self._message_protocol.send_msg(id)
-        response_type = self._message_protocol.receive_msg()
-        result_msg = self._message_protocol.receive_msg()
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-            'get_instrument', te-ts))
-        if self.__is_valid_response(response_type):
-            return result_msg
-        else:
-            raise OpenLISAException(result_msg)
+        return self.__request([COMMAND_GET_INSTRUMENT, id])
 
     def get_instrument_commands(self, id):
-        return json.loads(self.get_instrument_commands_as_json_string(id))
+        return serialization.loads(self.get_instrument_commands_as_json_string(id))
 
+    @with_latency_logs
     def get_instrument_commands_as_json_string(self, id):
-        id = str(id)
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format(
-            'get_instrument_commands'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_GET_INSTRUMENT_COMMANDS)
-        self._message_protocol.send_msg(id)
-        response_type = self._message_protocol.receive_msg()
-        result_msg = self._message_protocol.receive_msg()
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-            'get_instrument_commands', te-ts))
-        if self.__is_valid_response(response_type):
-            return result_msg
-        else:
-            raise OpenLISAException(result_msg)
+        return self.__request([COMMAND_GET_INSTRUMENT_COMMANDS, id])
 
+    @with_latency_logs
     def validate_command(self, id, command):
-        id = str(id)
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('validate_command'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_VALIDATE_COMMAND)
-        self._message_protocol.send_msg(id)
-        self._message_protocol.send_msg(command)
-        response_type = self._message_protocol.receive_msg()
-        if not self.__is_valid_response(response_type):
-            err = self._message_protocol.receive_msg()
-            te = time()
-            log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-                'validate_command', te-ts))
-            raise InvalidCommandException(
-                "command '{}' is not valid: {}".format(command, err))
-
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-            'validate_command', te-ts))
+        self.__request_ack([COMMAND_VALIDATE_COMMAND, id, command],
+                           invalid_command_invocation_exception(command))
 
     def send_command(self, id, command):
-        id = str(id)
-        json_str = self.send_command_and_result_as_json_string(id, command)
-        command_execution_result_dict = json.loads(json_str)
-        # BYTES are sent as a base64 string
-        if command_execution_result_dict["type"] == "BYTES":
-            command_execution_result_dict["value"] = base64.b64decode(
-                command_execution_result_dict["value"])
-        return command_execution_result_dict
+        return parse_command_execution_result(
+            self.send_command_and_result_as_json_string(id, command))
 
+    @with_latency_logs(context=lambda self, id, command: "[command={}]".format(command))
     def send_command_and_result_as_json_string(self, id, command):
-        id = str(id)
-        log.debug("[LATENCY_MEASURE][INIT][{}][command={}]".format(
-            'send_command', command))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_SEND_COMMAND)
-        self._message_protocol.send_msg(id)
-        self._message_protocol.send_msg(command)
-        response_type = self._message_protocol.receive_msg()
-        if self.__is_valid_response(response_type):
-            command_execution_result_json_str = self._message_protocol.receive_msg()
-            te = time()
-            log.debug("[LATENCY_MEASURE][FINISH][{}][command={}][ELAPSED={} seconds]".format(
-                'send_command', command, te-ts))
-
-            return command_execution_result_json_str
-        else:
-            err = self._message_protocol.receive_msg()
-            te = time()
-            log.debug("[LATENCY_MEASURE][FINISH][{}][command={}][ELAPSED={} seconds]".format(
-                'send_command', command, te-ts))
-            raise InvalidCommandException(
-                "command '{}' for instrument {} is not valid: {}".format(command, id, err))
+        return self.__request([COMMAND_SEND_COMMAND, id, command],
+                              invalid_command_exception(id, command))
 
+    @with_latency_logs
     def send_file(self, file_bytes, file_target_name):
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('send_file'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_SEND_FILE)
-        self._message_protocol.send_msg(file_target_name)
-        self._message_protocol.send_msg(file_bytes, encode=False)
-
-        response = self._message_protocol.receive_msg()
-        if not self.__is_valid_response(response):
-            err = self._message_protocol.receive_msg()
-            te = time()
-            log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format(
-                'send_file', te-ts))
-            raise InvalidPathException(err)
-
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format('send_file', te - ts))
+        return self.__request_ack(
+            [COMMAND_SEND_FILE, file_target_name, file_bytes], InvalidPathException)
+
+    @with_latency_logs
+    def send_file_stream(self, file, size, file_target_name):
+        """
+        Same as send_file but the size bytes are read from the file while they
+        are being sent, instead of being loaded in memory first
+        """
+        self._send_msgs([COMMAND_SEND_FILE, file_target_name])
+        self._message_protocol.send_stream(file, size)
+        response = self._receive_msg()
+        if not is_valid_response(response):
+            raise InvalidPathException(self._receive_msg())
 
         return response
 
-    def get_file(self, remote_file_name):
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('get_file'))
-        ts = time()
-        self._message_protocol.send_msg(COMMAND_GET_FILE)
-        self._message_protocol.send_msg(remote_file_name)
-        response_type = str(self._message_protocol.receive_msg())
-
-        if not self.__is_valid_response(response_type):
-            error_message = self._message_protocol.receive_msg()
-            log.error("Error requesting remote file '{}' : {}".format(remote_file_name, error_message))
-            raise OpenLISAException(error_message)
-
-        file_bytes = self._message_protocol.receive_msg(decode=False)
-
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format('get_file', te - ts))
-
-        return file_bytes
+    def __request_file(self, remote_file_name):
+        try:
+            self.__request_ack([COMMAND_GET_FILE, remote_file_name])
+        except OpenLISAException as e:
+            log.error("Error requesting remote file '{}' : {}".format(
+                remote_file_name, e.message))
+            raise
 
+    @with_latency_logs
+    def get_file(self, remote_file_name):
+        self.__request_file(remote_file_name)
+        return self._receive_msg(decode=False)
+
+    @with_latency_logs
+    def get_file_to(self, remote_file_name, file_target_name):
+        """
+        Same as get_file but the bytes are written to file_target_name as they
+        arrive. They are written to a temporary file next to the target, which
+        only replaces file_target_name once the whole file was received
+        """
+        self.__request_file(remote_file_name)
+        partial_file_name = file_target_name + PARTIAL_FILE_SUFFIX
+        try:
+            file = open(partial_file_name, "wb")
+        except OSError:
+            # The file is on its way anyway and must be read to keep the
+            # connection in sync with the server
+            self._message_protocol.discard_msg()
+            raise
+
+        try:
+            with file:
+                size = self._message_protocol.receive_stream(file)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(partial_file_name)
+            raise
+
+        os.replace(partial_file_name, file_target_name)
+        return size
+
+    @with_latency_logs
     def execute_bash_command(self, command, capture_stdout, capture_stderr):
-        log.debug("[LATENCY_MEASURE][INIT][{}]".format('execute_bash_command'))
-        ts = time()
         stdout = None
         stderr = None
-        self._message_protocol.send_msg(COMMAND_EXECUTE_BASH)
-        self._message_protocol.send_msg(command)
-        self._message_protocol.send_msg(str(capture_stdout))
-        self._message_protocol.send_msg(str(capture_stderr))
-        status_code = str(self._message_protocol.receive_msg())
+        self._send_msgs([
+            COMMAND_EXECUTE_BASH,
+            command,
+            str(capture_stdout),
+            str(capture_stderr),
+        ])
+        status_code = str(self._receive_msg())
         log.info("Status code after remote bash command execution: {}".format(status_code))
 
         if capture_stdout:
-            stdout = str(self._message_protocol.receive_msg())
+            stdout = str(self._receive_msg())
             log.debug("Remote execution command stdout: {}".format(stdout))
 
         if capture_stderr:
-            stderr = str(self._message_protocol.receive_msg())
+            stderr = str(self._receive_msg())
             log.debug("Remote execution command stderr: {}".format(stderr))
 
-        te = time()
-        log.debug("[LATENCY_MEASURE][FINISH][{}][ELAPSED={} seconds]".format('execute_bash_command', te - ts))
-
         return status_code, stdout, stderr
 
+    @with_latency_logs
     def reset_databases(self):
-        self._message_protocol.send_msg(COMMAND_RESET_DATABASES)
-        return self._message_protocol.receive_msg()
+        self._send_msg(COMMAND_RESET_DATABASES)
+        return self._receive_msg()
+
+
+class ClientProtocolPipeline:
+    """
+    Queues requests so all of them are sent in a single write when flushed.
+    The server answers requests in order, so the responses are read
+    afterwards paying a single round trip instead of one per request
+    """
+
+    def __init__(self, message_protocol: MessageProtocol):
+        self._message_protocol = message_protocol
+        self._msgs = []
+        self._requests = []
+        # Result message of each request, or the exception raised for it
+        self.results = []
+
+    def __queue(self, msgs, error_exception=OpenLISAException, has_response_type=True):
+        self._msgs.extend(msgs)
+        self._requests.append((error_exception, has_response_type))
+
+    def get_instruments_as_json_string(self):
+        self.__queue([COMMAND_GET_INSTRUMENTS], has_response_type=False)
+
+    def get_instrument_as_json_string(self, id):
+        self.__queue([COMMAND_GET_INSTRUMENT, id])
+
+    def get_instrument_commands_as_json_string(self, id):
+        self.__queue([COMMAND_GET_INSTRUMENT_COMMANDS, id])
+
+    def send_command_and_result_as_json_string(self, id, command):
+        self.__queue([COMMAND_SEND_COMMAND, id, command],
+                     invalid_command_exception(id, command))
+
+    @with_latency_logs
+    def flush(self):
+        """
+        Sends the queued requests and reads all their responses, then raises
+        the first error found if any request failed
+        """
+        self.results = []
+        if not self._requests:
+            return self.results
+
+        try:
+            self._message_protocol.send_msgs(self._msgs)
+            for error_exception, has_response_type in self._requests:
+                if not has_response_type:
+                    self.results.append(self._message_protocol.receive_msg())
+                    continue
+
+                response_type = self._message_protocol.receive_msg()
+                result_msg = self._message_protocol.receive_msg()
+                if is_valid_response(response_type):
+                    self.results.append(result_msg)
+                else:
+                    self.results.append(error_exception(result_msg))
+        finally:
+            # Requests are never sent twice, even if sending them failed
+            self._msgs = []
+            self._requests = []
+
+        for result in self.results:
+            if isinstance(result, Exception):
+                raise result
+
+        return self.results
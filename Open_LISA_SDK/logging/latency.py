@@ -0,0 +1,31 @@
+from functools import wraps
+from time import perf_counter
+
+from . import log
+
+
+def with_latency_logs(method=None, context=None):
+    """
+    Logs how long the decorated request takes, only when debug logs are enabled.
+    Can be applied as @with_latency_logs or as @with_latency_logs(context=...),
+    where context receives the request arguments and returns extra details to log
+    """
+    if method is None:
+        return lambda method: with_latency_logs(method, context)
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        if not log.is_debug_enabled():
+            return method(*args, **kwargs)
+
+        details = context(*args, **kwargs) if context else ""
+        log.debug("[LATENCY_MEASURE][INIT][{}]{}".format(method.__name__, details))
+        ts = perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            te = perf_counter()
+            log.debug("[LATENCY_MEASURE][FINISH][{}]{}[ELAPSED={:.8f} seconds]".format(
+                method.__name__, details, te - ts))
+
+    return wrapper
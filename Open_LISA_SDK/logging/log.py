@@ -7,8 +7,16 @@ consoleHandler = logging.StreamHandler()
 consoleHandler.setFormatter(logging.Formatter('[%(name)s] %(asctime)s %(levelname)-8s %(message)s'))
 logger.addHandler(consoleHandler)
 
+# Cached so hot paths can skip building debug messages without querying logging
+_debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
 def set_level(level):
+  global _debug_enabled
   logger.setLevel(level)
+  _debug_enabled = logger.isEnabledFor(logging.DEBUG)
+
+def is_debug_enabled():
+  return _debug_enabled
 
 def debug(msg):
   logger.debug(msg)
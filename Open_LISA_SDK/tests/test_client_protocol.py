@@ -0,0 +1,81 @@
+import os
+import socket
+import threading
+
+import pytest
+
+from ..common.protocol.message_protocol import MESSAGE_LENGTH_HEADER
+from ..common.protocol.message_protocol_tcp import MessageProtocolTCP
+from ..domain.protocol.client_protocol import ClientProtocol
+
+SOME_FILE_CONTENT = b"some file content"
+
+
+def frame(msg):
+    return MESSAGE_LENGTH_HEADER.pack(len(msg)) + msg
+
+
+def connect_to_fake_server(responses):
+    """
+    Returns a ClientProtocol whose server answers every request with the next
+    response in responses, ignoring the request frames
+    """
+    client_socket, server_socket = socket.socketpair()
+
+    def serve():
+        with server_socket:
+            for response in responses:
+                server_socket.recv(1024)
+                server_socket.sendall(response)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return ClientProtocol(MessageProtocolTCP(client_socket))
+
+
+def test_get_file_to_unwritable_target_keeps_connection_in_sync(tmp_path):
+    file_response = frame(b"OK") + frame(SOME_FILE_CONTENT)
+    client_protocol = connect_to_fake_server([file_response, file_response])
+    unwritable_target = str(tmp_path / "missing_directory" / "file")
+
+    with pytest.raises(FileNotFoundError):
+        client_protocol.get_file_to("remote_file", unwritable_target)
+    assert not os.path.exists(unwritable_target)
+
+    assert client_protocol.get_file("remote_file") == SOME_FILE_CONTENT
+
+
+class FullDiskFile:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def write(self, data):
+        raise OSError("No space left on device")
+
+
+def test_get_file_to_failing_write_keeps_connection_in_sync(tmp_path, monkeypatch):
+    file_response = frame(b"OK") + frame(SOME_FILE_CONTENT)
+    client_protocol = connect_to_fake_server([file_response, file_response])
+    target = str(tmp_path / "file")
+
+    with monkeypatch.context() as patch:
+        patch.setattr("builtins.open", lambda name, mode: FullDiskFile())
+        with pytest.raises(OSError):
+            client_protocol.get_file_to("remote_file", target)
+
+    assert client_protocol.get_file_to("remote_file", target) == len(SOME_FILE_CONTENT)
+    with open(target, "rb") as file:
+        assert file.read() == SOME_FILE_CONTENT
+    assert os.listdir(str(tmp_path)) == ["file"]
+
+
+def test_pipeline_does_not_send_requests_again_after_a_failed_flush():
+    client_protocol = connect_to_fake_server([b""])
+
+    with pytest.raises(ConnectionResetError):
+        with client_protocol.pipeline() as pipeline:
+            pipeline.get_instruments_as_json_string()
+
+    assert pipeline.flush() == []
@@ -165,3 +165,80 @@ def test_instrument_CRUDs():
         sdk.get_instrument(instrument_id=deleted_instrument["id"])
 
     sdk.disconnect()
+
+
+def test_reuse_connection_keeps_connection_open_between_sdk_instances():
+    sdk = SDK(log_level="ERROR")
+    sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT,
+                            reuse_connection=True)
+    sdk.get_instruments()
+    _, released_socket, _ = sdk._pooled_connection
+    sdk.disconnect()
+
+    other_sdk = SDK(log_level="ERROR")
+    other_sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT,
+                                  reuse_connection=True)
+    _, reused_socket, _ = other_sdk._pooled_connection
+    assert reused_socket is released_socket
+
+    instrument = other_sdk.get_instrument(
+        instrument_id=TEST_TEKTRONIX_OSC_INSTRUMENT_ID, response_format="PYTHON")
+    assert instrument["physical_address"] == TEST_TEKTRONIX_OSC_PHYSICAL_ADDRESS
+    other_sdk.disconnect()
+
+
+def test_sdk_that_released_its_connection_can_not_use_it_anymore():
+    sdk = SDK(log_level="ERROR")
+    sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT,
+                            reuse_connection=True)
+    sdk.disconnect()
+
+    other_sdk = SDK(log_level="ERROR")
+    other_sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT,
+                                  reuse_connection=True)
+
+    with pytest.raises(OpenLISAException, match="disconnected"):
+        sdk.get_instruments()
+    with pytest.raises(OpenLISAException, match="disconnected"):
+        sdk.disconnect()
+
+    instruments = other_sdk.get_instruments(response_format="PYTHON")
+    assert isinstance(instruments, list)
+    other_sdk.disconnect()
+
+
+def test_batch_returns_results_in_request_order():
+    sdk = SDK(log_level="ERROR")
+    sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT)
+    with sdk.batch() as batch:
+        batch.get_instruments(response_format="PYTHON")
+        batch.get_instrument(
+            instrument_id=TEST_TEKTRONIX_OSC_INSTRUMENT_ID, response_format="PYTHON")
+        batch.get_instrument_commands(
+            instrument_id=TEST_TEKTRONIX_OSC_INSTRUMENT_ID, response_format="JSON")
+
+    instruments, instrument, commands_json_string = batch.results
+    assert isinstance(instruments, list)
+    assert instrument["physical_address"] == TEST_TEKTRONIX_OSC_PHYSICAL_ADDRESS
+    assert SOME_VALID_TEKTRONIX_OSC_COMMAND in commands_json_string
+    sdk.disconnect()
+
+
+def test_batch_with_failed_request_raises_after_reading_every_response():
+    sdk = SDK(log_level="ERROR")
+    sdk.connect_through_TCP(host=LOCALHOST, port=SERVER_PORT)
+    with pytest.raises(OpenLISAException):
+        with sdk.batch() as batch:
+            batch.get_instrument(instrument_id=UNEXISTING_INSTRUMENT_ID)
+            batch.get_instrument(
+                instrument_id=TEST_TEKTRONIX_OSC_INSTRUMENT_ID, response_format="PYTHON")
+
+    failed_result, instrument = batch.results
+    assert isinstance(failed_result, OpenLISAException)
+    assert instrument["physical_address"] == TEST_TEKTRONIX_OSC_PHYSICAL_ADDRESS
+
+    # the connection is still in sync after the failed batch
+    instrument = sdk.get_instrument(
+        instrument_id=TEST_TEKTRONIX_OSC_INSTRUMENT_ID, response_format="PYTHON")
+    assert instrument["physical_address"] == TEST_TEKTRONIX_OSC_PHYSICAL_ADDRESS
+    sdk.disconnect()